@@ -1,15 +1,26 @@
 import re
 import os
-from collections import defaultdict
+import io
+import stat
+import codecs
+import mmap
+import tempfile
+import functools
 import argparse
 from pathlib import Path
+from typing import Dict, Generator, Iterator, List, NamedTuple, Optional, Set, TextIO, Tuple
 
 # Regex patterns to parse the clippings file
-# Pattern for the book title and author line
+# Pattern for the book title and author line (fallback for the str-based
+# fast path in iter_highlights)
 # Handles authors like (Author, Name), (Author), (Author1; Author2)
 TITLE_AUTHOR_RE = re.compile(r"^(.*?)\s+\((.*?)\)$")
 
-# Pattern for the metadata line (page/location, date)
+# Prefix of the metadata line for highlights
+HIGHLIGHT_PREFIX = "- Your Highlight on "
+
+# Pattern for the metadata line (page/location, date), used as a fallback
+# for the str-based fast path in parse_metadata
 METADATA_RE = re.compile(
     r"^- Your Highlight on (page (?P<page>\d+(-?\d+)?) \| )?" # Optional page number/range
     r"(Location (?P<location>\d+(-?\d+)?)\s*\| |"           # Optional location number/range (needs page OR location)
@@ -17,10 +28,30 @@ METADATA_RE = re.compile(
     r"Added on (?P<date>.*?)$"                              # Date added
 )
 
+# A single parsed highlight: its text and the attribution line shown below it
+class Highlight(NamedTuple):
+    text: str
+    attribution: str
+
 # Separator between clippings
 SEPARATOR = "=========="
-
-def sanitize_filename(filename):
+SEPARATOR_BYTES = SEPARATOR.encode()
+
+# Maximum number of Markdown files kept open while streaming
+MAX_OPEN_FILES = 16
+# Prefix and suffix of the temporary files written while streaming
+TEMP_PREFIX = ".kindle-"
+TEMP_SUFFIX = ".md.tmp"
+
+# Patterns used by sanitize_filename
+# Translation table deleting characters invalid in most filesystems
+# (colons are handled separately)
+_DELETE_TABLE = str.maketrans('', '', '\\/*?"<>|')
+# Runs of consecutive whitespace
+_WS_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=4096)
+def sanitize_filename(filename: str) -> str:
     """
     Removes or replaces characters invalid in filenames, keeping spaces
     and replacing colons with dashes.
@@ -28,9 +59,9 @@ def sanitize_filename(filename):
     # Replace colons with dashes first
     sanitized = filename.replace(":", " -")
     # Remove characters invalid in most filesystems (excluding colon now)
-    sanitized = re.sub(r'[\\/*?"<>|]', "", sanitized)
+    sanitized = sanitized.translate(_DELETE_TABLE)
     # Replace multiple consecutive whitespace characters with a single space
-    sanitized = re.sub(r'\s+', ' ', sanitized)
+    sanitized = _WS_RE.sub(' ', sanitized)
     # Remove leading/trailing whitespace
     sanitized = sanitized.strip()
     # Limit length (optional, but good practice)
@@ -45,136 +76,441 @@ def sanitize_filename(filename):
             sanitized = sanitized[:max_len]
     return sanitized
 
-def parse_clippings(input_file_path):
+def _is_number_or_range(value: str) -> bool:
     """
-    Parses the 'My Clippings.txt' file and returns a dictionary
-    structured by book.
+    Checks for a page/location value such as '42' or '468-469'.
     """
-    try:
-        # Use utf-8-sig to handle the BOM (Byte Order Mark) often present
-        with open(input_file_path, 'r', encoding='utf-8-sig') as f:
-            content = f.read()
-    except FileNotFoundError:
-        print(f"Error: Input file not found at '{input_file_path}'")
+    return (
+        value.replace("-", "", 1).isdecimal()
+        and not value.startswith("-")
+        and not value.endswith("-")
+    )
+
+def parse_metadata(line: str) -> Optional[Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """
+    Parses a '- Your Highlight on ...' metadata line and returns a
+    (page, location, date) tuple, with None for missing parts, or None
+    if the line isn't a recognized highlight.
+    """
+    if not line.startswith(HIGHLIGHT_PREFIX):
         return None
-    except Exception as e:
-        print(f"Error reading input file: {e}")
+
+    # Fast path: split on the ' | ' delimiters with plain string operations
+    parts = line[len(HIGHLIGHT_PREFIX):].split(" | ")
+    page: Optional[str] = None
+    location: Optional[str] = None
+    for part in parts[:-1]:
+        # The page must be followed by exactly one space before '|'
+        if part.startswith("page ") and page is None and location is None:
+            page = part[5:]
+            if not _is_number_or_range(page):
+                break
+        elif part.startswith("Location ") and location is None:
+            # Extra whitespace is allowed between the location and '|'
+            location = part[9:].rstrip()
+            if not _is_number_or_range(location):
+                break
+        else:
+            break
+    else:
+        if parts[-1].startswith("Added on "):
+            return page, location, parts[-1][9:]
+
+    # Fall back to the regex for less common layouts
+    metadata_match = METADATA_RE.match(line)
+    if not metadata_match:
         return None
+    metadata = metadata_match.groupdict()
+    # Handle the two possible location formats
+    loc = metadata.get('location') or metadata.get('location_only')
+    if loc:
+        # Remove "Location " prefix if it exists from location_only
+        loc = loc.replace("Location ", "").strip()
+    return metadata.get('page'), loc, metadata.get('date')
+
+def _separator_line_end(mm: mmap.mmap, sep: int, line_start: int) -> int:
+    """
+    Returns the offset just past the separator line found at sep, or -1
+    if the match isn't a line of its own (e.g. part of a longer '=' run).
+    """
+    if sep != line_start and mm[sep - 1] not in b"\r\n":
+        return -1
+    pos = sep + len(SEPARATOR_BYTES)
+    size = len(mm)
+    # Allow trailing whitespace after the separator
+    while pos < size and mm[pos] in b" \t\x0b\x0c":
+        pos += 1
+    if pos == size:
+        return pos
+    if mm[pos] == ord("\r"):
+        pos += 1
+        if pos < size and mm[pos] == ord("\n"):
+            pos += 1
+        return pos
+    if mm[pos] == ord("\n"):
+        return pos + 1
+    return -1
+
+def _decode_clipping(data: bytes, offset: int) -> str:
+    """
+    Decodes the bytes of one clipping, which start at the given file
+    offset, and normalizes its line endings.
+    """
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Positions in the error are relative to the clipping; report
+        # where the bad byte is in the file as well
+        raise UnicodeDecodeError(
+            e.encoding, e.object, e.start, e.end,
+            f"{e.reason} (at byte {offset + e.start} of the file)",
+        ) from None
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+def _iter_text_clippings(f: TextIO) -> Iterator[str]:
+    """
+    Yields the raw text of each clipping from an open text file, reading
+    it line by line so only one clipping is held in memory.
+    """
+    buf: List[str] = []
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line.rstrip() == SEPARATOR:
+            yield "\n".join(buf)
+            buf = []
+        else:
+            buf.append(line)
+    # Text after the last separator (possibly empty)
+    yield "\n".join(buf)
 
-    clippings = content.split(SEPARATOR)
-    print(f"Found {len(clippings)} potential clippings (including separators).")
+def _iter_mapped_clippings(mm: mmap.mmap) -> Iterator[str]:
+    """
+    Yields the raw text of each clipping from a memory-mapped file,
+    decoding only the bytes of one clipping at a time.
+    """
+    # Skip the BOM (Byte Order Mark) often present
+    start = len(codecs.BOM_UTF8) if mm[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+    search_from = start
+    while True:
+        sep = mm.find(SEPARATOR_BYTES, search_from)
+        if sep == -1:
+            break
+        line_end = _separator_line_end(mm, sep, start)
+        if line_end == -1:
+            search_from = sep + 1
+            continue
+        yield _decode_clipping(mm[start:sep], start)
+        start = search_from = line_end
+    # Text after the last separator (possibly empty)
+    yield _decode_clipping(mm[start:], start)
 
-    # Use defaultdict to easily append highlights to lists
-    books = defaultdict(list)
-    processed_count = 0
+def iter_clippings(input_file_path: str) -> Iterator[str]:
+    """
+    Yields the raw text of each clipping in the 'My Clippings.txt' file.
+    Regular files are memory-mapped so the whole file is never held as
+    a string; pipes and other special files are read line by line.
+    """
+    with open(input_file_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            # FIFOs, process substitution and /dev/stdin can't be mapped
+            # Use utf-8-sig to handle the BOM (Byte Order Mark) often present
+            yield from _iter_text_clippings(io.TextIOWrapper(f, encoding='utf-8-sig'))
+        elif st.st_size == 0:
+            # mmap can't map an empty file
+            yield ""
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from _iter_mapped_clippings(mm)
 
-    for clipping in clippings:
-        clipping = clipping.strip() # Remove leading/trailing whitespace
-        if not clipping:
-            continue # Skip empty sections resulting from split
+def iter_highlights(input_file_path: str) -> Generator[Tuple[Tuple[str, str], Highlight], None, int]:
+    """
+    Parses the 'My Clippings.txt' file and yields a ((title, author),
+    highlight) pair for every highlight, in file order.
+    Returns the number of potential clippings (including separators).
+    """
+    # Maps a raw title line to its parsed (title, author) key
+    seen_keys: Dict[str, Tuple[str, str]] = {}
+    clipping_count = 0
 
-        lines = clipping.split('\n')
-        if len(lines) < 3:
-            # print(f"Skipping invalid clipping (too few lines): {lines[:1]}...") # Optional: for debugging
+    for clipping in iter_clippings(input_file_path):
+        clipping_count += 1
+        if not clipping:
+            continue # Skip empty sections between separators before stripping
+        # Remove leading/trailing whitespace; whitespace-only sections end up
+        # empty and are skipped by the line check below
+        clipping = clipping.strip()
+
+        # Locate the end of the title and metadata lines; the rest of the
+        # clipping is the highlight text, so it is sliced off in one piece
+        first_nl = clipping.find('\n')
+        second_nl = clipping.find('\n', first_nl + 1) if first_nl != -1 else -1
+        if second_nl == -1:
+            # print(f"Skipping invalid clipping (too few lines): {clipping[:first_nl]}...") # Optional: for debugging
             continue
+        raw_title_line = clipping[:first_nl]
+        metadata_line = clipping[first_nl + 1:second_nl]
 
         # --- 1. Parse Title and Author ---
-        title_author_match = TITLE_AUTHOR_RE.match(lines[0])
-        if not title_author_match:
-            # print(f"Skipping clipping - couldn't parse title/author: {lines[0]}") # Optional: for debugging
-            continue
-        title = title_author_match.group(1).strip()
-        author = title_author_match.group(2).strip()
-        book_key = (title, author) # Use tuple as dict key
+        # The same title line repeats for every highlight of a book,
+        # so only parse it the first time it is seen
+        book_key = seen_keys.get(raw_title_line)
+        if book_key is None:
+            # Fast path: split "Title (Author)" at the last " (" so titles
+            # containing parentheses keep them, e.g. "Book (Series 1) (Author)"
+            idx = raw_title_line.rfind(' (') if raw_title_line.endswith(')') else -1
+            author = raw_title_line[idx + 2:-1]
+            if idx >= 0 and '(' not in author and ')' not in author:
+                title = raw_title_line[:idx].strip()
+                author = author.strip()
+            else:
+                # Fall back to the regex for less common spacing and for
+                # authors containing parentheses, e.g. "Title (Author (Jr.))"
+                title_author_match = TITLE_AUTHOR_RE.match(raw_title_line)
+                if not title_author_match:
+                    # print(f"Skipping clipping - couldn't parse title/author: {raw_title_line}") # Optional: for debugging
+                    continue
+                title = title_author_match.group(1).strip()
+                author = title_author_match.group(2).strip()
+            book_key = (title, author) # Use tuple as dict key
+            seen_keys[raw_title_line] = book_key
 
         # --- 2. Parse Metadata ---
-        metadata_match = METADATA_RE.match(lines[1])
-        if not metadata_match:
-            # print(f"Skipping clipping - couldn't parse metadata: {lines[1]}") # Optional: for debugging
+        metadata = parse_metadata(metadata_line)
+        if metadata is None:
+            # print(f"Skipping clipping - couldn't parse metadata: {metadata_line}") # Optional: for debugging
             continue
-        metadata = metadata_match.groupdict()
+        page, location, date = metadata
 
         # Construct attribution string
-        attribution_parts = []
-        if metadata.get('page'):
-            attribution_parts.append(f"Page {metadata['page']}")
-        # Handle the two possible location formats
-        loc = metadata.get('location') or metadata.get('location_only')
-        if loc:
-            # Remove "Location " prefix if it exists from location_only
-            loc_val = loc.replace("Location ", "").strip()
-            attribution_parts.append(f"Location {loc_val}")
-        if metadata.get('date'):
-            attribution_parts.append(f"Added on {metadata['date']}")
-        attribution = " | ".join(attribution_parts)
+        if page and location and date:
+            # Most common case: build it in one go
+            attribution = f"Page {page} | Location {location} | Added on {date}"
+        else:
+            attribution = " | ".join(part for part in (
+                f"Page {page}" if page else None,
+                f"Location {location}" if location else None,
+                f"Added on {date}" if date else None,
+            ) if part)
 
         # --- 3. Extract Highlight Text ---
-        highlight_text = "\n".join(lines[2:]).strip()
+        highlight_text = clipping[second_nl + 1:].strip()
         if not highlight_text:
             # print(f"Skipping clipping - empty highlight text for: {title}") # Optional: for debugging
             continue
 
-        # Store the parsed data
-        books[book_key].append({"text": highlight_text, "attribution": attribution})
-        processed_count += 1
+        yield book_key, Highlight(highlight_text, attribution)
+
+    return clipping_count
+
+def _book_header(author: str) -> str:
+    """
+    Returns the text at the top of a book's Markdown file.
+    """
+    # --- MODIFICATION: Removed H1 Title ---
+    # No f"# {title}\n" heading here
 
-    print(f"Successfully processed {processed_count} clippings from {len(books)} books.")
-    return books
+    # Author and separator (placed at the top now)
+    return f"_by {author}_\n\n---\n\n"
 
-def create_markdown_files(books, output_dir):
+def _format_highlight(highlight: Highlight, first: bool) -> str:
     """
-    Creates Markdown files for each book in the specified directory.
-    Removes H1 title, uses spaces in filenames, replaces colons with dashes.
+    Returns the Markdown for one highlight, preceded by a separator
+    unless it is the first highlight of the book.
+    """
+    # Format highlight text as a blockquote, adding the marker to each
+    # line (the text was stripped at parse time, so no trailing newline)
+    quote = "> " + highlight.text.replace("\n", "\n> ") + "\n"
+    # The separator between highlights is written before the next one,
+    # so none follows the last highlight
+    separator = "" if first else "---\n\n"
+    # Add attribution below the quote
+    return f"{separator}{quote}\n_– {highlight.attribution}_\n\n"
+
+def stream_markdown_files(
+    input_file_path: str,
+    output_dir: str,
+    verbose: bool = False,
+    max_open_files: int = MAX_OPEN_FILES,
+) -> Optional[int]:
+    """
+    Parses the 'My Clippings.txt' file and appends each highlight to a
+    temporary file for its book as soon as it is read, instead of
+    collecting all books in memory first. At most max_open_files files
+    are kept open; the least recently used one is closed and reopened
+    in append mode if its book shows up again.
+    The temporary files only replace the books' Markdown files once the
+    whole input has been read, so existing notes are left untouched if
+    it can't be.
+    Returns the number of files created, or None if the input file
+    couldn't be read or had no highlights.
     """
     output_path = Path(output_dir)
-    # Create the output directory if it doesn't exist
-    output_path.mkdir(parents=True, exist_ok=True)
-    print(f"\nWriting Markdown files to: '{output_path.resolve()}'")
+    out_dir_str = str(output_path)
+
+    # Output filename per book; None once the book is skipped, either
+    # because writing failed or a later book took over its filename
+    book_files: Dict[Tuple[str, str], Optional[str]] = {}
+    # Book currently written to each filename
+    file_owners: Dict[str, Tuple[str, str]] = {}
+    failed_files: Set[str] = set()
+    # Temporary file created for each output filename; only these are
+    # ever removed, so other files in the output directory are left alone
+    temp_paths: Dict[str, str] = {}
+    # Permissions for new files, as open() would give them
+    file_mode = 0o666
+    # Open temporary files (by output filename) in least to most
+    # recently used order
+    open_files: Dict[str, TextIO] = {}
+    processed_count = 0
+    clipping_count = 0
+    completed = False
 
-    file_count = 0
-    for (title, author), highlights in books.items():
-        # Create a safe filename from the title using the updated sanitizer
-        filename_base = sanitize_filename(title)
-        output_filename = output_path / f"{filename_base}.md"
+    def close_file(filename: str) -> None:
+        f = open_files.pop(filename, None)
+        if f is None:
+            return
+        try:
+            f.close()
+        except OSError as e:
+            print(f"Error writing file '{os.path.basename(filename)}': {e}")
+            failed_files.add(filename)
+
+    def remove_temp_file(filename: str) -> None:
+        temp_path = temp_paths.pop(filename, None)
+        if temp_path is None:
+            return
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
 
+    def create_temp_file() -> Tuple[str, TextIO]:
+        fd, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX, prefix=TEMP_PREFIX, dir=out_dir_str)
         try:
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                # --- MODIFICATION: Removed H1 Title ---
-                # f.write(f"# {title}\n") # <-- This line is removed/commented out
-
-                # Write author and separator (placed at the top now)
-                f.write(f"_by {author}_\n\n")
-                f.write("---\n\n") # Separator after author
-
-                # Sort highlights (optional, e.g., by date or location if needed,
-                # but requires more complex parsing of the attribution string)
-                # For now, keep the order they appeared in the clippings file.
-
-                for i, highlight in enumerate(highlights):
-                    # Format highlight text as a blockquote
-                    quote_lines = highlight['text'].split('\n')
-                    for line in quote_lines:
-                        f.write(f"> {line}\n") # Add blockquote marker to each line
-
-                    # Add attribution below the quote
-                    f.write(f"\n_– {highlight['attribution']}_\n")
-
-                    # Add a separator between highlights, but not after the last one
-                    if i < len(highlights) - 1:
-                        f.write("\n---\n\n")
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temp_path, file_mode)
+            return temp_path, os.fdopen(fd, 'w', encoding='utf-8')
+        except OSError:
+            os.close(fd)
+            os.remove(temp_path)
+            raise
+
+    highlights = iter_highlights(input_file_path)
+    try:
+        while True:
+            # Only errors raised while reading the input are reported as such
+            try:
+                book_key, highlight = next(highlights)
+            except StopIteration as e:
+                clipping_count = e.value
+                break
+            except FileNotFoundError:
+                print(f"Error: Input file not found at '{input_file_path}'")
+                return None
+            except Exception as e:
+                print(f"Error reading input file: {e}")
+                return None
+            processed_count += 1
+
+            first = book_key not in book_files
+            if first:
+                if not file_owners:
+                    # Create the output directory once there is something to write
+                    try:
+                        output_path.mkdir(parents=True, exist_ok=True)
+                    except OSError as e:
+                        print(f"Error creating output directory '{output_dir}': {e}")
+                        return 0
+                    # Read the umask without changing it
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    file_mode = 0o666 & ~umask
+                # Create a safe filename from the title using the updated sanitizer
+                filename_base = sanitize_filename(book_key[0])
+                output_filename = os.path.join(out_dir_str, filename_base + ".md")
+                # Books sharing a filename overwrite each other, so the last
+                # one to appear in the clippings file wins
+                previous_owner = file_owners.get(output_filename)
+                if previous_owner is not None:
+                    print(
+                        f"Warning: '{previous_owner[0]}' by {previous_owner[1]} has the same "
+                        f"filename as '{book_key[0]}' by {book_key[1]}; its highlights were not written."
+                    )
+                    book_files[previous_owner] = None
+                    close_file(output_filename)
+                    remove_temp_file(output_filename)
+                    failed_files.discard(output_filename)
+                file_owners[output_filename] = book_key
+                book_files[book_key] = output_filename
+            else:
+                known_filename = book_files[book_key]
+                if known_filename is None:
+                    continue
+                output_filename = known_filename
+
+            try:
+                f = open_files.pop(output_filename, None)
+                if f is None:
+                    if first:
+                        temp_paths[output_filename], f = create_temp_file()
                     else:
-                        f.write("\n") # Just a newline after the last one
+                        f = open(temp_paths[output_filename], 'a', encoding='utf-8')
+                # (Re)insert as the most recently used file
+                open_files[output_filename] = f
+                if first:
+                    f.write(_book_header(book_key[1]))
+                f.write(_format_highlight(highlight, first))
+            except OSError as e:
+                print(f"Error writing file '{os.path.basename(output_filename)}': {e}")
+                book_files[book_key] = None
+                failed_files.add(output_filename)
+                close_file(output_filename)
+                continue
+
+            if len(open_files) > max_open_files:
+                close_file(next(iter(open_files)))
+        completed = True
+    finally:
+        for filename in list(open_files):
+            close_file(filename)
+        if not completed:
+            # Leave any existing Markdown files as they were
+            for filename in list(temp_paths):
+                remove_temp_file(filename)
+
+    print(f"Found {clipping_count} potential clippings (including separators).")
+    print(f"Successfully processed {processed_count} clippings from {len(book_files)} books.")
+    if not book_files:
+        # Nothing to write, so treat it like a parsing failure
+        return None
+    print(f"\nWriting Markdown files to: '{output_path.resolve()}'")
 
-            print(f"Created: {output_filename.name}")
-            file_count += 1
-        except Exception as e:
-            print(f"Error writing file '{output_filename.name}': {e}")
+    # The whole input was read: move the finished files into place
+    file_count = 0
+    for filename in file_owners:
+        if filename in failed_files:
+            remove_temp_file(filename)
+            continue
+        try:
+            os.replace(temp_paths[filename], filename)
+        except OSError as e:
+            print(f"Error writing file '{os.path.basename(filename)}': {e}")
+            remove_temp_file(filename)
+            continue
+        del temp_paths[filename]
+        if verbose:
+            print(f"Created: {os.path.basename(filename)}")
+        file_count += 1
 
     print(f"\nFinished creating {file_count} Markdown files.")
+    return file_count
 
 
 # --- Main Execution ---
-if __name__ == "__main__":
+def main() -> None:
     # Set up argument parser for command-line usage
     parser = argparse.ArgumentParser(
         description="Convert Kindle 'My Clippings.txt' to Markdown files per book."
@@ -191,6 +527,12 @@ if __name__ == "__main__":
         default="Kindle_Markdown_Notes", # Default output directory name
         help="Directory to save the generated Markdown files (default: Kindle_Markdown_Notes)",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print the name of each Markdown file as it is created",
+    )
 
     args = parser.parse_args()
 
@@ -201,11 +543,12 @@ if __name__ == "__main__":
     print(f"Input file: '{input_file_path}'")
     print(f"Output directory: '{output_directory}'")
 
-    # Parse the clippings
-    parsed_books = parse_clippings(input_file_path)
+    # Parse the clippings, writing each highlight to its book's file as we go
+    file_count = stream_markdown_files(input_file_path, output_directory, verbose=args.verbose)
 
-    # Create Markdown files if parsing was successful
-    if parsed_books:
-        create_markdown_files(parsed_books, output_directory)
-    else:
-        print("Exiting due to parsing errors.")
\ No newline at end of file
+    if file_count is None:
+        print("Exiting due to parsing errors.")
+
+
+if __name__ == "__main__":
+    main()
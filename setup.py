@@ -0,0 +1,35 @@
+"""
+Optional packaging for kindle_to_markdown.
+
+The script runs as-is with plain Python. Installing it with this file
+also compiles the module with mypyc when mypy is available, which
+removes most of the interpreter overhead from the parsing loop:
+
+    pip install mypy setuptools wheel
+    pip install --no-build-isolation .
+
+Without mypy the module is installed as regular Python. Either way this
+provides a `kindle-to-markdown` command.
+"""
+from setuptools import setup
+
+try:
+    from mypyc.build import mypycify
+except ImportError:
+    # mypyc not installed: fall back to the pure-Python module
+    ext_modules = []
+else:
+    ext_modules = mypycify(["kindle_to_markdown.py"])
+
+setup(
+    name="kindle_to_markdown",
+    version="1.0.0",
+    description="Convert Kindle 'My Clippings.txt' to Markdown files per book.",
+    license="MIT",
+    py_modules=["kindle_to_markdown"],
+    ext_modules=ext_modules,
+    entry_points={
+        "console_scripts": ["kindle-to-markdown=kindle_to_markdown:main"],
+    },
+    python_requires=">=3.6",
+)